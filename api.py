@@ -7,12 +7,16 @@ from datetime import datetime
 import logging
 import hashlib
 import re
+import time
 import uuid
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
 import scoring
-from store import Store
+from store import Store, connect
+from snapshot import SnapshotStore
+from deadline import DeadlineExceeded, time_left
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -23,12 +27,14 @@ FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+GATEWAY_TIMEOUT = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
 }
 UNKNOWN = 0
 MALE = 1
@@ -38,6 +44,11 @@ GENDERS = {
     MALE: "male",
     FEMALE: "female",
 }
+# request time budget in seconds, unless given by the X-Request-Timeout header
+METHOD_TIMEOUTS = {
+    "online_score": None,
+    "clients_interests": None,
+}
 
 
 class ValidationError(Exception):
@@ -236,7 +247,8 @@ class ClientsInterestsHandler(BaseHandler):
 
     def get_result(self):
         self._fill_context()
-        return {clid: scoring.get_interests(self.store, clid)
+        deadline = self.ctx.get("deadline")
+        return {clid: scoring.get_interests(self.store, clid, time_left(deadline))
                 for clid in self.request.client_ids}
 
 
@@ -259,7 +271,8 @@ class OnlineScoreHandler(BaseHandler):
                 self.request.birthday,
                 self.request.gender,
                 self.request.first_name,
-                self.request.last_name
+                self.request.last_name,
+                ctx=self.ctx
             )
         }
 
@@ -295,6 +308,19 @@ def check_auth(request):
     return False
 
 
+def get_timeout(headers, method):
+    timeout = headers.get("X-Request-Timeout")
+    if timeout is None:
+        return METHOD_TIMEOUTS.get(method)
+    try:
+        timeout = int(timeout)
+    except ValueError:
+        raise ValidationError("X-Request-Timeout should be int milliseconds")
+    if timeout <= 0:
+        raise ValidationError("X-Request-Timeout should be positive")
+    return timeout / 1000.0
+
+
 def method_handler(request, ctx, store):
     request_map = {
         'online_score': OnlineScoreRequest,
@@ -317,15 +343,25 @@ def method_handler(request, ctx, store):
     req = request_map[method_request.method](method_request.arguments)
     try:
         req.validate_fields()
+        timeout = get_timeout(request["headers"], method_request.method)
     except ValidationError, e:
         return e.message, INVALID_REQUEST
+    if timeout is not None:
+        ctx["deadline"] = ctx.get("started", time.time()) + timeout
 
     handler = get_handler(req, ctx, store, is_admin=method_request.is_admin)
-    result = handler.get_result()
+    try:
+        result = handler.get_result()
+    except DeadlineExceeded, e:
+        return e.message, GATEWAY_TIMEOUT
 
     return result, OK
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
@@ -337,7 +373,7 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         response, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
+        context = {"request_id": self.get_request_id(self.headers), "started": time.time()}
         request = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
@@ -369,15 +405,90 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         self.wfile.write(json.dumps(r))
         return
 
+    def get_stats(self):
+        stats = {
+            "scoring": scoring.get_stats(),
+        }
+        if scoring.scheduler is not None:
+            stats["score_batching"] = scoring.scheduler.get_stats()
+        if self.store.replicas:
+            stats["redis_reads"] = self.store.read_stats()
+        if self.store.index is not None:
+            stats["interests_index"] = self.store.index_stats()
+        if isinstance(self.store, SnapshotStore):
+            stats["interests_snapshot"] = self.store.snapshot_stats()
+        return stats
+
+    def do_GET(self):
+        if self.path.strip("/") == "stats":
+            code, r = OK, self.get_stats()
+        else:
+            code, r = NOT_FOUND, {"error": ERRORS[NOT_FOUND], "code": NOT_FOUND}
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(r))
+
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--score-ttl", action="store", type=int, default=scoring.SCORE_TTL,
+                  help="seconds a cached score is served as fresh")
+    op.add_option("--score-stale-ttl", action="store", type=int, default=scoring.SCORE_STALE_TTL,
+                  help="seconds a cached score may be served stale while refreshing")
+    op.add_option("--score-ttl-jitter", action="store", type=float, default=scoring.SCORE_TTL_JITTER,
+                  help="max random extension of score TTL, as a fraction of it")
+    op.add_option("--score-batch-window", action="store", type=float, default=0,
+                  help="ms to gather concurrent score calculations into one batch, 0 disables batching")
+    op.add_option("--score-batch-size", action="store", type=int, default=32,
+                  help="max score calculations in one batch")
+    op.add_option("--score-processes", action="store", type=int, default=0,
+                  help="worker processes to score batches in, 0 scores in the server process")
+    op.add_option("--interests-index-capacity", action="store", type=int, default=0,
+                  help="expected number of client ids with interests, 0 disables the bloom index")
+    op.add_option("--interests-index-error-rate", action="store", type=float, default=0.01,
+                  help="target false positive rate of the interests index")
+    op.add_option("--interests-index-rebuild", action="store", type=int, default=60 * 60,
+                  help="seconds between interests index rebuilds from a key scan")
+    op.add_option("--interests-snapshot", action="store", default=None,
+                  help="serve clients_interests from this snapshot file instead of redis")
+    op.add_option("--interests-snapshot-check", action="store", type=int, default=10,
+                  help="seconds between checks for a new interests snapshot")
+    op.add_option("--redis", action="store", default="localhost:6379",
+                  help="host:port of the redis primary")
+    op.add_option("--redis-replica", action="append", default=[],
+                  help="host:port of a redis read replica, may be repeated")
+    op.add_option("--hedge-percentile", action="store", type=int, default=95,
+                  help="latency percentile after which a read is duplicated to another node")
+    op.add_option("--online-score-timeout", action="store", type=int, default=0,
+                  help="default online_score time budget in ms, 0 for none")
+    op.add_option("--clients-interests-timeout", action="store", type=int, default=0,
+                  help="default clients_interests time budget in ms, 0 for none")
     (opts, args) = op.parse_args()
+    if opts.interests_snapshot and opts.interests_index_capacity:
+        op.error("--interests-index-capacity has no effect with --interests-snapshot, "
+                 "interests are not read from redis then")
     logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+                        format='[%(asctime)s.%(msecs)03d] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    METHOD_TIMEOUTS["online_score"] = opts.online_score_timeout / 1000.0 or None
+    METHOD_TIMEOUTS["clients_interests"] = opts.clients_interests_timeout / 1000.0 or None
+    scoring.configure_cache(opts.score_ttl, opts.score_stale_ttl, opts.score_ttl_jitter)
+    if opts.score_batch_window > 0:
+        scoring.configure_batching(opts.score_batch_window / 1000.0, opts.score_batch_size,
+                                   opts.score_processes)
+    MainHTTPHandler.store = Store(opts.interests_index_capacity, opts.interests_index_error_rate,
+                                  primary=connect(opts.redis),
+                                  replicas=[connect(r) for r in opts.redis_replica],
+                                  hedge_percentile=opts.hedge_percentile)
+    if opts.interests_index_capacity:
+        MainHTTPHandler.store.rebuild_index_every(opts.interests_index_rebuild)
+    if opts.interests_snapshot:
+        MainHTTPHandler.store = SnapshotStore(opts.interests_snapshot, MainHTTPHandler.store)
+        MainHTTPHandler.store.reload_every(opts.interests_snapshot_check)
+    server = ThreadingHTTPServer(("localhost", opts.port), MainHTTPHandler)
     logging.info("Starting server at %s" % opts.port)
     try:
         server.serve_forever()
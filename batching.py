@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+import Queue
+from collections import Counter
+
+from deadline import DeadlineExceeded
+
+
+class Job(object):
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.queued = time.time()
+        self.queue_delay = None
+        self.batch_size = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+
+# gathers items submitted from concurrent threads and hands them to
+# batch_func together: a batch is closed `window` seconds after its first
+# item arrived or once it holds `max_batch_size` items
+class BatchScheduler(object):
+    def __init__(self, batch_func, window=0.005, max_batch_size=32):
+        self.batch_func = batch_func
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.stats = Counter()
+        self._queue = Queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, item, timeout=None):
+        job = Job(item)
+        self._queue.put(job)
+        if not job.done.wait(timeout):
+            # nobody waits for it any more, leave it out of its batch
+            job.cancelled = True
+            raise DeadlineExceeded("Batched job timed out")
+        if job.error is not None:
+            raise job.error
+        return job
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        if stats.get("batches"):
+            stats["avg_batch_size"] = float(stats["items"]) / stats["batches"]
+            stats["avg_queue_delay_ms"] = float(stats["queue_delay_ms"]) / stats["items"]
+        return stats
+
+    def _collect(self):
+        # jobs already waiting (e.g. queued while the previous batch ran) are
+        # always taken; the window only bounds waiting for more of them
+        batch = [self._queue.get()]
+        close_at = batch[0].queued + self.window
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except Queue.Empty:
+                pass
+            remaining = close_at - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [job for job in self._collect() if not job.cancelled]
+            if not batch:
+                continue
+            started = time.time()
+            try:
+                results = self.batch_func([job.item for job in batch])
+            except Exception as e:
+                logging.exception("Batch of %d failed: %s" % (len(batch), e))
+                results = [None] * len(batch)
+                for job in batch:
+                    job.error = e
+            delays = []
+            for job, result in zip(batch, results):
+                job.result = result
+                job.queue_delay = started - job.queued
+                job.batch_size = len(batch)
+                delays.append(job.queue_delay)
+            with self._stats_lock:
+                self.stats["batches"] += 1
+                self.stats["items"] += len(batch)
+                self.stats["queue_delay_ms"] += int(sum(delays) * 1000)
+                self.stats["max_queue_delay_ms"] = max(self.stats["max_queue_delay_ms"],
+                                                       int(max(delays) * 1000))
+                self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+            for job in batch:
+                job.done.set()
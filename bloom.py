@@ -0,0 +1,47 @@
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.nbits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.nhashes = max(1, int(round(float(self.nbits) / capacity * math.log(2))))
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+        # tag of the data the filter was built from, set by its owner
+        self.generation = None
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        # double hashing: k positions out of two 64-bit halves of one digest
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        for i in xrange(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, key):
+        # re-adding a key (or one indistinguishable from it) sets no new bit
+        # and must not inflate the count the error rate is estimated from
+        added = False
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    def false_positive_rate(self):
+        # estimate for the number of keys actually added so far
+        return (1 - math.exp(-float(self.nhashes) * self.count / self.nbits)) ** self.nhashes
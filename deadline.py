@@ -0,0 +1,15 @@
+import time
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def time_left(deadline):
+    # seconds left until `deadline` (None for no deadline), raises once it passed
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return left
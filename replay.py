@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# replays requests recorded in the api.py log against a running server:
+#   $ python replay.py -u http://127.0.0.1:8080 --speed 2 -c 8 api.log
+
+import ast
+import logging
+import re
+import sys
+import threading
+import time
+import urllib2
+import Queue
+from collections import Counter
+from datetime import datetime
+from optparse import OptionParser
+
+LOG_LINE = re.compile(r"^\[(?P<ts>[^\]]+)\] (?P<level>\w) (?P<message>.*)$")
+REQUEST_MESSAGE = re.compile(r"^(?P<path>/\S*): (?P<body>.*) (?P<request_id>\S+)$")
+LOG_DATEFMT = "%Y.%m.%d %H:%M:%S"
+# api.py logs milliseconds after the seconds, older logs do not have them
+LOG_MSECS = re.compile(r"^(?P<ts>.*?)(?:\.(?P<msecs>\d{3}))?$")
+
+
+class Record(object):
+    def __init__(self, ts, path, body, request_id):
+        self.ts = ts
+        self.path = path
+        self.body = body
+        self.request_id = request_id
+        self.code = None
+        self.replayed_code = None
+        self.latency = None
+        self.scheduled = None
+        self.lag = None
+
+
+def parse_ts(value):
+    m = LOG_MSECS.match(value)
+    ts = time.mktime(datetime.strptime(m.group("ts"), LOG_DATEFMT).timetuple())
+    return ts + int(m.group("msecs") or 0) / 1000.0
+
+
+def parse_log(lines):
+    # request lines are "<path>: <body> <request_id>", the response context
+    # dict logged after it carries the same request_id and the response code
+    records = []
+    by_id = {}
+    for line in lines:
+        m = LOG_LINE.match(line.rstrip("\n"))
+        if not m or m.group("level") != "I":
+            continue
+        message = m.group("message")
+        if message.startswith("{"):
+            try:
+                context = ast.literal_eval(message)
+            except (SyntaxError, ValueError):
+                continue
+            record = by_id.get(context.get("request_id"))
+            if record is not None and record.code is None:
+                record.code = context.get("code")
+            continue
+        m_req = REQUEST_MESSAGE.match(message)
+        if not m_req:
+            continue
+        ts = parse_ts(m.group("ts"))
+        record = Record(ts, m_req.group("path"), m_req.group("body"), m_req.group("request_id"))
+        records.append(record)
+        by_id[record.request_id] = record
+    return records
+
+
+def send(url, record, timeout):
+    req = urllib2.Request(url + record.path, data=record.body,
+                          headers={"Content-Type": "application/json",
+                                   "X-Request-ID": record.request_id})
+    # latency counts from when the request was due, not from when it could
+    # be sent: waiting for a free client is part of what the user sees
+    started = time.time()
+    if record.scheduled is not None:
+        record.lag = started - record.scheduled
+        started = record.scheduled
+    try:
+        f_http = urllib2.urlopen(req, timeout=timeout)
+        f_http.read()
+        record.replayed_code = f_http.code
+    except urllib2.HTTPError as e:
+        record.replayed_code = e.code
+    except Exception as e:
+        logging.debug("Request %s failed: %s" % (record.request_id, e))
+    record.latency = time.time() - started
+
+
+def replay(records, url, speed=1.0, concurrency=1, timeout=10):
+    # speed is a multiplier of the recorded pace, 0 replays as fast as possible;
+    # the queue is unbounded so that a slow server never holds the pace back
+    queue = Queue.Queue()
+
+    def worker():
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+            send(url, record, timeout)
+
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in workers:
+        t.daemon = True
+        t.start()
+    started = time.time()
+    for record in records:
+        if speed:
+            record.scheduled = started + (record.ts - records[0].ts) / speed
+            delay = record.scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        queue.put(record)
+    for _ in workers:
+        queue.put(None)
+    for t in workers:
+        t.join()
+    return time.time() - started
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def report(records, elapsed):
+    # failed requests (timeouts, connection errors) got no response,
+    # their latency is just how long it took to give up on them
+    latencies = [r.latency * 1000 for r in records if r.replayed_code is not None]
+    failed = sum(1 for r in records if r.replayed_code is None)
+    diffs = Counter((r.code, r.replayed_code) for r in records
+                    if r.code != r.replayed_code)
+    lines = ["requests: %d in %.1fs (%.1f rps)" %
+             (len(records), elapsed, len(records) / elapsed if elapsed else 0),
+             "failed: %d" % failed]
+    for p in (50, 90, 99, 100):
+        lines.append("p%d latency: %.1fms" % (p, percentile(latencies, p) or 0))
+    lags = [r.lag * 1000 for r in records if r.lag is not None]
+    if lags:
+        lines.append("behind schedule: p50 %.1fms, p99 %.1fms, max %.1fms" %
+                     (percentile(lags, 50), percentile(lags, 99), max(lags)))
+    lines.append("codes: %s" % dict(Counter(r.replayed_code for r in records)))
+    for (code, replayed_code), n in diffs.most_common():
+        lines.append("code diff: recorded %s, replayed %s: %d" % (code, replayed_code, n))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] LOGFILE...")
+    op.add_option("-u", "--url", action="store", default="http://127.0.0.1:8080")
+    op.add_option("-s", "--speed", action="store", type=float, default=1.0,
+                  help="multiplier of the recorded pace, 0 for max speed")
+    op.add_option("-c", "--concurrency", action="store", type=int, default=1)
+    op.add_option("-t", "--timeout", action="store", type=float, default=10)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt=LOG_DATEFMT)
+    records = []
+    for fname in args or ["-"]:
+        f = sys.stdin if fname == "-" else open(fname)
+        records.extend(parse_log(f))
+    records.sort(key=lambda r: r.ts)
+    logging.info("Replaying %d requests against %s" % (len(records), opts.url))
+    elapsed = replay(records, opts.url, opts.speed, opts.concurrency, opts.timeout)
+    print report(records, elapsed)
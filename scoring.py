@@ -1,19 +1,60 @@
 import hashlib
 import json
+import logging
+import random
+import threading
+import time
+import Queue
+from collections import Counter
+from multiprocessing import Pool
 
+from batching import BatchScheduler
+from deadline import time_left
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
-    key_parts = [
-        first_name or "",
-        last_name or "",
-        birthday.strftime("%Y%m%d") if birthday is not None else "",
-    ]
-    key = "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return score
+# score cache settings: an entry is fresh for SCORE_TTL seconds (randomly
+# stretched by up to SCORE_TTL_JITTER of it, so keys written together do not
+# expire together), then may be served stale for SCORE_STALE_TTL more seconds
+# while a single background refresh recomputes it
+SCORE_TTL = 60 * 60
+SCORE_STALE_TTL = 10 * 60
+SCORE_TTL_JITTER = 0.1
+# stale keys are refreshed by a fixed set of threads; refreshes that do not
+# fit into the queue are dropped, the key is served stale until a later hit
+REFRESH_THREADS = 4
+REFRESH_QUEUE_SIZE = 1000
+
+stats = Counter()
+_stats_lock = threading.Lock()
+# set by configure_batching(): scores cache misses in micro-batches
+scheduler = None
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_refresh_queue = None
+
+
+def _count(name):
+    # the server is threaded, bare += on a Counter may lose updates
+    with _stats_lock:
+        stats[name] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(stats)
+
+
+def configure_cache(ttl=None, stale_ttl=None, jitter=None):
+    global SCORE_TTL, SCORE_STALE_TTL, SCORE_TTL_JITTER
+    if ttl is not None:
+        SCORE_TTL = ttl
+    if stale_ttl is not None:
+        SCORE_STALE_TTL = stale_ttl
+    if jitter is not None:
+        SCORE_TTL_JITTER = jitter
+
+
+def calc_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -22,11 +63,110 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score,  60 * 60)
     return score
 
 
-def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
+def _calc_score_args(args):
+    return calc_score(*args)
+
+
+def calc_scores(batch, pool=None):
+    if pool is not None:
+        return pool.map(_calc_score_args, batch)
+    return [calc_score(*args) for args in batch]
+
+
+def configure_batching(window, max_batch_size, processes=0):
+    # the pool has to be forked before any serving threads are started
+    global scheduler
+    pool = Pool(processes) if processes else None
+    scheduler = BatchScheduler(lambda batch: calc_scores(batch, pool),
+                               window, max_batch_size)
+
+
+def _time_left(ctx):
+    return time_left(ctx.get("deadline")) if ctx is not None else None
+
+
+def _calc(args, ctx=None):
+    if scheduler is None:
+        return calc_score(*args)
+    job = scheduler.submit(args, _time_left(ctx))
+    if ctx is not None:
+        ctx["score_queue_delay_ms"] = int(job.queue_delay * 1000)
+        ctx["score_batch_size"] = job.batch_size
+    return job.result
+
+
+def _cache_score(store, key, score, ctx=None):
+    soft_ttl = SCORE_TTL * (1 + random.uniform(0, SCORE_TTL_JITTER))
+    entry = {"score": score, "expires": time.time() + soft_ttl}
+    store.cache_set(key, entry, int(soft_ttl + SCORE_STALE_TTL), _time_left(ctx))
+
+
+def _refresh(store, key, args):
+    try:
+        _cache_score(store, key, _calc(args))
+        _count("refreshes")
+    except Exception as e:
+        _count("refresh_errors")
+        logging.exception("Score refresh for %s failed: %s" % (key, e))
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def _refresh_worker(queue):
+    while True:
+        _refresh(*queue.get())
+
+
+def _start_refresh(store, key, args):
+    global _refresh_queue
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        if _refresh_queue is None:
+            # started on first use, after the scoring processes are forked
+            _refresh_queue = Queue.Queue(REFRESH_QUEUE_SIZE)
+            for _ in range(REFRESH_THREADS):
+                t = threading.Thread(target=_refresh_worker, args=(_refresh_queue,))
+                t.daemon = True
+                t.start()
+        try:
+            _refresh_queue.put_nowait((store, key, args))
+        except Queue.Full:
+            _count("refreshes_dropped")
+            return
+        _refreshing.add(key)
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None,
+              ctx=None):
+    key_parts = [
+        first_name or "",
+        last_name or "",
+        birthday.strftime("%Y%m%d") if birthday is not None else "",
+    ]
+    key = "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
+    args = (phone, email, birthday, gender, first_name, last_name)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    entry = store.cache_get(key, _time_left(ctx))
+    if isinstance(entry, dict):
+        if entry["expires"] <= time.time():
+            # soft-expired: answer with the stale score, refresh in background
+            _count("stale_served")
+            _start_refresh(store, key, args)
+        return entry["score"]
+    elif entry:
+        # plain score written before soft expiry was introduced
+        return entry
+    score = _calc(args, ctx)
+    _cache_score(store, key, score, ctx)
+    return score
+
+
+def get_interests(store, cid, timeout=None):
+    r = store.get("i:%s" % cid, timeout)
     return r
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# read-only snapshot of interests records, memory-mapped by the server:
+#   header: magic, version, number of records
+#   index:  (client id, value offset, value length) sorted by client id
+#   values: packed json values
+# build it from redis or from json lines of {"cid": ..., "interests": [...]}:
+#   $ python snapshot.py -o interests.snap --redis localhost:6379
+#   $ python snapshot.py -o interests.snap interests.jsonl
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from optparse import OptionParser
+
+from store import INTERESTS_PREFIX, connect
+
+MAGIC = "ISNP"
+VERSION = 1
+HEADER = struct.Struct("<4sIQ")
+ENTRY = struct.Struct("<qQI")
+
+
+def compile_snapshot(records, path):
+    # records are (client id, json encoded value) pairs; the file is written
+    # aside and renamed over `path`, so readers never see it half-written
+    records = sorted(records)
+    values_start = HEADER.size + ENTRY.size * len(records)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records)))
+        offset = values_start
+        for cid, value in records:
+            f.write(ENTRY.pack(cid, offset, len(value)))
+            offset += len(value)
+        for cid, value in records:
+            f.write(value)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return len(records)
+
+
+class _Ids(object):
+    # sorted client ids as a sequence read straight from the mapped index
+    def __init__(self, mm, count):
+        self.mm = mm
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return ENTRY.unpack_from(self.mm, HEADER.size + i * ENTRY.size)[0]
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.version = (st.st_ino, st.st_mtime)
+        try:
+            self._check()
+        except ValueError:
+            self.mm.close()
+            raise
+        self._ids = _Ids(self.mm, self.count)
+
+    def _check(self):
+        # a file still being copied in place has a valid header but is short
+        size = len(self.mm)
+        if size < HEADER.size:
+            raise ValueError("%s is truncated" % self.path)
+        magic, version, self.count = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not an interests snapshot v%d" % (self.path, VERSION))
+        if size < HEADER.size + self.count * ENTRY.size:
+            raise ValueError("%s is truncated in the index" % self.path)
+        if self.count:
+            _, offset, length = ENTRY.unpack_from(self.mm, HEADER.size + (self.count - 1) * ENTRY.size)
+            if offset + length > size:
+                raise ValueError("%s is truncated in the values" % self.path)
+
+    def get(self, cid):
+        i = bisect_left(self._ids, cid)
+        if i == self.count:
+            return None
+        found, offset, length = ENTRY.unpack_from(self.mm, HEADER.size + i * ENTRY.size)
+        if found != cid:
+            return None
+        return json.loads(self.mm[offset:offset + length])
+
+
+class SnapshotStore(object):
+    # serves interests from a snapshot, everything else from `fallback`
+    def __init__(self, path, fallback):
+        self.path = path
+        self.fallback = fallback
+        self.snapshot = Snapshot(path)
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+    def reload(self):
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            logging.error("Interests snapshot %s is gone: %s" % (self.path, e))
+            return False
+        if (st.st_ino, st.st_mtime) == self.snapshot.version:
+            return False
+        try:
+            snapshot = Snapshot(self.path)
+        except (ValueError, EnvironmentError) as e:
+            # e.g. copied in place and not complete yet, retried next time
+            logging.error("Interests snapshot %s not loaded, keeping the old one: %s" %
+                          (self.path, e))
+            return False
+        # readers still holding the old snapshot keep its mapping alive
+        self.snapshot = snapshot
+        logging.info("Interests snapshot %s loaded: %d records" % (self.path, self.snapshot.count))
+        return True
+
+    def reload_every(self, period):
+        def run():
+            while not stop.wait(period):
+                try:
+                    self.reload()
+                except Exception as e:
+                    logging.exception("Interests snapshot reload failed: %s" % e)
+
+        stop = threading.Event()
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return stop
+
+    def snapshot_stats(self):
+        return {
+            "path": self.snapshot.path,
+            "records": self.snapshot.count,
+            "nbytes": len(self.snapshot.mm),
+        }
+
+    def cache_get(self, key, timeout=None):
+        return self.fallback.cache_get(key, timeout)
+
+    def cache_set(self, key, value, ttl, timeout=None):
+        return self.fallback.cache_set(key, value, ttl, timeout)
+
+    def get(self, key, timeout=None):
+        if not key.startswith(INTERESTS_PREFIX):
+            return self.fallback.get(key, timeout)
+        try:
+            cid = int(key[len(INTERESTS_PREFIX):])
+        except ValueError:
+            cid = None
+        value = self.snapshot.get(cid) if cid is not None else None
+        if value is None:
+            raise RuntimeError("Key %s is not set!" % key)
+        return value
+
+
+def records_from_redis(r):
+    for key in r.scan_iter(match=INTERESTS_PREFIX + "*", count=1000):
+        try:
+            cid = int(key[len(INTERESTS_PREFIX):])
+        except ValueError:
+            logging.warning("Skipping non-integer client id key %s" % key)
+            continue
+        value = r.get(key)
+        if value is not None:
+            yield cid, value
+
+
+def records_from_file(f):
+    for line in f:
+        if line.strip():
+            record = json.loads(line)
+            yield int(record["cid"]), json.dumps(record["interests"])
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog -o SNAPSHOT [--redis HOST:PORT] [FILE.jsonl...]")
+    op.add_option("-o", "--output", action="store", default=None)
+    op.add_option("--redis", action="store", default=None,
+                  help="host:port of redis to read i:<cid> records from")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    if not opts.output:
+        op.error("output snapshot path is required")
+    records = {}
+    if opts.redis:
+        records.update(records_from_redis(connect(opts.redis)))
+    for fname in args:
+        with open(fname) as f:
+            records.update(records_from_file(f))
+    n = compile_snapshot(records.items(), opts.output)
+    logging.info("Written %d records to %s" % (n, opts.output))
@@ -1,23 +1,350 @@
+import logging
+import threading
+import time
 import redis
 import json
+import Queue
+from collections import Counter, deque
+from multiprocessing.pool import ThreadPool
+
+from bloom import BloomFilter
+from deadline import DeadlineExceeded, time_left
+
+INTERESTS_PREFIX = "i:"
+# bumped (INCR) by every writer of interests records, e.g. after a nightly load
+INDEX_GENERATION_KEY = "interests:generation"
+
+
+CONNECT_TIMEOUT = 1.0
+
+
+class BudgetConnection(redis.Connection):
+    # a connection made for a command run by `execute` is bounded by what is
+    # left of its budget, not just by socket_connect_timeout
+    budget = threading.local()
+
+    def _connect(self):
+        timeout = getattr(self.budget, "timeout", None)
+        connect_timeout = self.socket_connect_timeout
+        if timeout is not None and (connect_timeout is None or timeout < connect_timeout):
+            self.socket_connect_timeout = timeout
+        try:
+            return super(BudgetConnection, self)._connect()
+        finally:
+            self.socket_connect_timeout = connect_timeout
+
+
+def execute(client, timeout, *args):
+    # runs a redis command with `timeout` seconds (what is left of a request
+    # budget) as its socket timeout: a timed out command is not left running
+    # in background, the connection is dropped instead
+    if timeout is None:
+        return client.execute_command(*args)
+    pool = client.connection_pool
+    BudgetConnection.budget.timeout = timeout
+    try:
+        conn = pool.get_connection(args[0])
+    except redis.TimeoutError:
+        raise DeadlineExceeded("%s %s timed out connecting" % args[:2])
+    finally:
+        BudgetConnection.budget.timeout = None
+    try:
+        conn._sock.settimeout(timeout)
+        conn.send_command(*args)
+        return client.parse_response(conn, args[0])
+    except redis.TimeoutError:
+        conn.disconnect()
+        raise DeadlineExceeded("%s %s timed out" % args[:2])
+    except Exception:
+        conn.disconnect()
+        raise
+    finally:
+        if conn._sock is not None:
+            conn._sock.settimeout(conn.socket_timeout)
+        pool.release(conn)
+
+
+def connect(address, connect_timeout=CONNECT_TIMEOUT):
+    host, _, port = address.partition(":")
+    pool = redis.ConnectionPool(connection_class=BudgetConnection, host=host or "localhost",
+                                port=int(port or 6379), socket_connect_timeout=connect_timeout)
+    return redis.Redis(connection_pool=pool)
+
+
+class LatencyTracker(object):
+    # percentile of the last `window` latencies, recomputed every `every` samples
+    def __init__(self, percentile=95, window=1000, every=50, initial=0.01):
+        self.percentile = percentile
+        self.every = every
+        self.samples = deque(maxlen=window)
+        self.value = initial
+        self._pending = 0
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self._pending += 1
+        if self._pending >= self.every:
+            self._pending = 0
+            samples = sorted(self.samples)
+            self.value = samples[min(len(samples) - 1, len(samples) * self.percentile // 100)]
+
+
+class Node(object):
+    # a redis client with its own bounded set of worker threads, so that
+    # a slow node can not hold up the reads sent to the others
+    def __init__(self, client, threads=16):
+        self.client = client
+        self.threads = threads
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, args):
+        with self._lock:
+            # started on first use, so that forking the scoring processes
+            # happens before any of its threads exist
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+        return self._pool.apply_async(func, args)
+
 
 class Store(object):
     _r = None
 
-    def __init__(self):
+    def __init__(self, index_capacity=0, index_error_rate=0.01, primary=None, replicas=(),
+                 hedge_percentile=95, min_hedge_delay=0.001, read_timeout=5.0, node_threads=16,
+                 index_check=1.0):
+        if primary is not None:
+            self._r = primary
         if not self._r:
-            self._r = redis.Redis()
+            self._r = connect("localhost")
+        # reads go round-robin to replicas (or the primary if there are none);
+        # a read not answered within the hedge delay is duplicated to the
+        # next node and whichever answers first wins. Every node has its own
+        # threads, and reads whose caller already got an answer are dropped,
+        # so a slow node's backlog does not delay reads from the others.
+        # Writes go to the primary.
+        self.replicas = list(replicas)
+        self._nodes = [Node(r, node_threads) for r in self.replicas + [self._r]]
+        self._next_node = 0
+        self.latency = LatencyTracker(hedge_percentile)
+        self.min_hedge_delay = min_hedge_delay
+        self.read_timeout = read_timeout
+        # optional bloom filter of keys known to hold interests records,
+        # lets get() answer "definitely absent" without a round-trip. It only
+        # knows about keys written before it was built, so it is trusted only
+        # while the generation key has not changed since (checked at most
+        # every `index_check` seconds); otherwise get() asks redis and the
+        # index is rebuilt in background
+        self.index = None
+        self.index_capacity = index_capacity
+        self.index_error_rate = index_error_rate
+        self.index_check = index_check
+        self._seen_generation = None
+        self._index_checked = 0
+        self._rebuild_lock = threading.Lock()
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._index_next = None
+
+    def rebuild_index(self):
+        if not self._rebuild_lock.acquire(False):
+            return
+        try:
+            self._rebuild_index()
+        finally:
+            self._rebuild_lock.release()
+
+    def _rebuild_index(self):
+        index = BloomFilter(self.index_capacity, self.index_error_rate)
+        # read before the scan: a load finishing during it bumps the
+        # generation again and makes this index untrusted right away
+        generation = self._r.get(INDEX_GENERATION_KEY)
+        # keys written while scanning may be missed by the scan,
+        # so writes go to the index being built as well
+        with self._index_lock:
+            self._index_next = index
+        try:
+            for key in self._r.scan_iter(match=INTERESTS_PREFIX + "*", count=1000):
+                with self._index_lock:
+                    index.add(key)
+            index.generation = generation
+            with self._index_lock:
+                self.index = index
+        finally:
+            with self._index_lock:
+                self._index_next = None
+        logging.info("Interests index rebuilt: %d keys, %d bytes, fp rate %.4f" %
+                     (index.count, index.nbytes, index.false_positive_rate()))
+
+    def rebuild_index_every(self, period):
+        def run():
+            while not stop.is_set():
+                try:
+                    self.rebuild_index()
+                except Exception as e:
+                    logging.exception("Interests index rebuild failed: %s" % e)
+                stop.wait(period)
+
+        stop = threading.Event()
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+        return stop
+
+    def _start_rebuild(self):
+        t = threading.Thread(target=self.rebuild_index)
+        t.daemon = True
+        t.start()
+
+    def _index_trusted(self, index, deadline=None):
+        now = time.time()
+        if now - self._index_checked >= self.index_check:
+            self._index_checked = now
+            self._seen_generation = execute(self._r, time_left(deadline), "GET", INDEX_GENERATION_KEY)
+            if self._seen_generation != index.generation:
+                self._start_rebuild()
+        return self._seen_generation == index.generation
 
-    def cache_get(self, key):
-        val =  self._r.get(key)
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def index_stats(self):
+        if self.index is None:
+            return None
+        with self._stats_lock:
+            skipped = self.stats["index_skips"]
+        return {
+            "keys": self.index.count,
+            "nbytes": self.index.nbytes,
+            "false_positive_rate": self.index.false_positive_rate(),
+            "skipped_lookups": skipped,
+        }
+
+    def read_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            "reads": stats.get("reads", 0),
+            "hedges_fired": stats.get("hedges_fired", 0),
+            "hedges_won": stats.get("hedges_won", 0),
+            "hedge_delay_ms": self.latency.value * 1000,
+        }
+
+    def _timed_get(self, node, key, results, hedge, answered, deadline):
+        if answered.is_set():
+            # queued behind slow reads until its caller got an answer elsewhere
+            return
+        started = time.time()
+        try:
+            results.put((hedge, execute(node, time_left(deadline), "GET", key), None))
+        except Exception as e:
+            results.put((hedge, None, e))
+            return
+        self.latency.add(time.time() - started)
+
+    def _pooled_get(self, key, deadline):
+        # reads from a replica, hedged to the next node if it is slow or fails,
+        # giving up with DeadlineExceeded once `deadline` has passed and with
+        # redis.TimeoutError after read_timeout
+        i = self._next_node = (self._next_node + 1) % len(self.replicas)
+        node, hedge_node = self._nodes[i], self._nodes[i + 1]
+        give_up = time.time() + self.read_timeout
+        results = Queue.Queue()
+        answered = threading.Event()
+        # the node threads give up at the same time as the caller
+        node_deadline = give_up if deadline is None else min(deadline, give_up)
+        node.submit(self._timed_get, (node.client, key, results, False, answered, node_deadline))
+        pending = 1
+        try:
+            while True:
+                wait = give_up - time.time()
+                left = time_left(deadline)
+                if left is not None:
+                    wait = min(wait, left)
+                if hedge_node is not None:
+                    wait = min(wait, max(self.latency.value, self.min_hedge_delay))
+                try:
+                    hedge, val, error = results.get(timeout=max(wait, 0))
+                    pending -= 1
+                except Queue.Empty:
+                    if hedge_node is None and time.time() < give_up:
+                        raise DeadlineExceeded("Read of %s timed out" % key)
+                    if hedge_node is None:
+                        raise redis.TimeoutError("Read of %s timed out" % key)
+                    hedge, val, error = None, None, None
+                if error is None and hedge is not None:
+                    break
+                if hedge_node is not None:
+                    time_left(deadline)
+                    self._count("hedges_fired")
+                    hedge_node.submit(self._timed_get,
+                                      (hedge_node.client, key, results, True, answered,
+                                       node_deadline))
+                    hedge_node = None
+                    pending += 1
+                if not pending:
+                    time_left(deadline)
+                    if isinstance(error, DeadlineExceeded):
+                        # the nodes ran out of read_timeout, not of the request budget
+                        raise redis.TimeoutError("Read of %s timed out" % key)
+                    raise error
+        finally:
+            answered.set()
+        if hedge:
+            self._count("hedges_won")
+        return val
+
+    def cache_get(self, key, timeout=None):
+        self._count("reads")
+        if self.replicas:
+            deadline = time.time() + timeout if timeout is not None else None
+            val = self._pooled_get(key, deadline)
+        elif timeout is None:
+            val = self._r.get(key)
+        else:
+            val = execute(self._r, timeout, "GET", key)
         return json.loads(val) if val else None
 
-    def cache_set(self, key, value, ttl):
+    def cache_set(self, key, value, ttl, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
         value = json.dumps(value)
-        self._r.set(key, value, ttl)
+        if timeout is None:
+            self._r.set(key, value, ttl)
+        else:
+            execute(self._r, timeout, "SET", key, value, "EX", ttl)
+        if key.startswith(INTERESTS_PREFIX):
+            self._index_add(key)
+            # lets the other servers' indexes know they miss this key
+            generation = execute(self._r, time_left(deadline), "INCR", INDEX_GENERATION_KEY)
+            self._index_advance(generation)
+
+    def _index_advance(self, generation):
+        # our own write is already in our index: if nobody else wrote since
+        # it was built, it is up to date with the generation we just made
+        with self._index_lock:
+            index = self.index
+            if index is None or int(index.generation or 0) + 1 != generation:
+                return
+            if self._seen_generation == index.generation:
+                self._seen_generation = str(generation)
+            index.generation = str(generation)
 
-    def get(self, key):
-        value = self.cache_get(key)
+    def _index_add(self, key):
+        with self._index_lock:
+            for index in (self.index, self._index_next):
+                if index is not None:
+                    index.add(key)
+
+    def get(self, key, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        index = self.index
+        if (index is not None and key.startswith(INTERESTS_PREFIX) and
+                key not in index and self._index_trusted(index, deadline)):
+            self._count("index_skips")
+            raise RuntimeError("Key %s is not set!" % key)
+        value = self.cache_get(key, time_left(deadline))
         if value is None:
             raise RuntimeError("Key %s is not set!" % key)
         return value
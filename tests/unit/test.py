@@ -9,10 +9,24 @@ import mock
 import json
 import unittest
 import traceback
+import time
+import threading
+import socket
+import Queue
 
 PROJECT_ROOT = os.path.join(os.path.dirname(__file__), "..", "..")
 sys.path.append(PROJECT_ROOT)
 import api
+import scoring
+import batching
+import bloom
+import store
+import replay
+import snapshot
+import tempfile
+import redis
+import deadline
+import shutil
 
 
 def cases(cases):
@@ -34,16 +48,66 @@ def cases(cases):
 
 
 class TestStore(object):
-    def cache_set(self, key, val, ttl):
+    def cache_set(self, key, val, ttl, timeout=None):
         pass
 
-    def cache_get(self, key):
+    def cache_get(self, key, timeout=None):
         return None
 
-    def get(self, key):
+    def get(self, key, timeout=None):
         return ['interest1', 'interest2']
 
 
+class DictStore(object):
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def cache_set(self, key, val, ttl, timeout=None):
+        self.data[key] = val
+        self.ttls[key] = ttl
+
+    def cache_get(self, key, timeout=None):
+        return self.data.get(key)
+
+    def get(self, key, timeout=None):
+        return self.data[key]
+
+
+class FakeRedis(object):
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+        self.reads = []
+        self.scans = 0
+
+    def get(self, key):
+        if key != store.INDEX_GENERATION_KEY:
+            self.reads.append(key)
+        return self.data.get(key)
+
+    def set(self, key, value, ttl):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1)
+        return int(self.data[key])
+
+    def execute_command(self, command, *args):
+        return getattr(self, command.lower())(*args)
+
+    def scan_iter(self, match, count):
+        self.scans += 1
+        return iter([k for k in self.data if k.startswith(match.rstrip("*"))])
+
+
+def wait_until(func_true, timeout=1):
+    time_start = time.time()
+    while not func_true():
+        if time.time() > time_start + timeout:
+            raise AssertionError("Timeout after %s sec" % timeout)
+        time.sleep(0.01)
+
+
 class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
@@ -164,6 +228,566 @@ class TestSuite(unittest.TestCase):
                             for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    @cases(["0", "-5", "soon"])
+    def test_invalid_timeout_header(self, timeout):
+        self.headers["X-Request-Timeout"] = timeout
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertTrue(len(response))
+
+    def test_deadline_stops_lookups(self):
+        self.headers["X-Request-Timeout"] = "50"
+        self.settings.get = mock.Mock(side_effect=lambda key, timeout: time.sleep(0.03) or ["i"])
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": range(10)}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.GATEWAY_TIMEOUT, code)
+        self.assertTrue(len(response))
+        self.assertEqual(self.settings.get.call_count, 2)
+        self.assertTrue(all(0 < c[0][1] <= 0.05 for c in self.settings.get.call_args_list))
+
+    def test_method_default_timeout(self):
+        self.context["started"] = time.time() - 1
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"first_name": "a", "last_name": "b"}}
+        self.set_valid_auth(request)
+        with mock.patch.dict(api.METHOD_TIMEOUTS, {"online_score": 0.5}):
+            _, code = self.get_response(request)
+        self.assertEqual(api.GATEWAY_TIMEOUT, code)
+        self.context = {}
+        _, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+
+
+class TestScoreCache(unittest.TestCase):
+    def setUp(self):
+        self.store = DictStore()
+        scoring.stats.clear()
+
+    def get_score(self):
+        return scoring.get_score(self.store, "79175002040", "stupnikov@otus.ru")
+
+    def test_miss_sets_jittered_ttl(self):
+        self.assertEqual(self.get_score(), 3.0)
+        (key, entry), = self.store.data.items()
+        soft_ttl = entry["expires"] - time.time()
+        self.assertTrue(scoring.SCORE_TTL - 1 <= soft_ttl <= scoring.SCORE_TTL * (1 + scoring.SCORE_TTL_JITTER))
+        self.assertTrue(self.store.ttls[key] >= scoring.SCORE_TTL + scoring.SCORE_STALE_TTL)
+
+    def test_fresh_hit(self):
+        self.get_score()
+        (key, entry), = self.store.data.items()
+        entry["score"] = 5
+        with mock.patch.object(scoring, "_start_refresh") as refresh:
+            self.assertEqual(self.get_score(), 5)
+            self.assertFalse(refresh.called)
+        self.assertEqual(scoring.stats["stale_served"], 0)
+
+    def test_stale_hit_refreshes_once(self):
+        self.get_score()
+        (key, entry), = self.store.data.items()
+        entry.update(score=5, expires=time.time() - 1)
+        release = threading.Event()
+        calc = scoring._calc
+
+        def slow_calc(args, ctx=None):
+            release.wait()
+            return calc(args, ctx)
+
+        scores = []
+        with mock.patch.object(scoring, "_calc", slow_calc):
+            threads = [threading.Thread(target=lambda: scores.append(self.get_score()))
+                       for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            release.set()
+            wait_until(lambda: not scoring._refreshing)
+        self.assertEqual(scores, [5, 5])
+        self.assertEqual(scoring.stats["stale_served"], 2)
+        self.assertEqual(scoring.stats["refreshes"], 1)
+        self.assertEqual(self.get_score(), 3.0)
+
+    def test_full_refresh_queue_drops(self):
+        self.get_score()
+        (key, entry), = self.store.data.items()
+        entry.update(expires=time.time() - 1)
+        with mock.patch.object(scoring, "_refresh_queue", Queue.Queue(1)) as queue:
+            queue.put(None)
+            self.get_score()
+            self.assertEqual(scoring.stats["refreshes_dropped"], 1)
+            self.assertNotIn(key, scoring._refreshing)
+
+
+class TestBatchScheduler(unittest.TestCase):
+    def run_concurrently(self, scheduler, items):
+        jobs = {}
+
+        def submit(item):
+            jobs[item] = scheduler.submit(item)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in items]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return jobs
+
+    def test_batches_concurrent_items(self):
+        batches = []
+
+        def square(batch):
+            batches.append(len(batch))
+            return [i * i for i in batch]
+
+        scheduler = batching.BatchScheduler(square, window=0.2, max_batch_size=3)
+        jobs = self.run_concurrently(scheduler, range(5))
+        self.assertEqual({i: j.result for i, j in jobs.items()}, {i: i * i for i in range(5)})
+        self.assertTrue(max(batches) <= 3)
+        self.assertEqual(sum(batches), 5)
+        self.assertTrue(all(j.batch_size in batches for j in jobs.values()))
+        stats = scheduler.get_stats()
+        self.assertEqual(stats["items"], 5)
+        self.assertEqual(stats["batches"], len(batches))
+
+    def test_backlog_batched_under_load(self):
+        batches = []
+
+        def slow(batch):
+            batches.append(len(batch))
+            time.sleep(0.05)
+            return batch
+
+        scheduler = batching.BatchScheduler(slow, window=0.005, max_batch_size=32)
+        jobs = self.run_concurrently(scheduler, range(40))
+        self.assertEqual(sorted(j.result for j in jobs.values()), range(40))
+        self.assertEqual(sum(batches), 40)
+        self.assertTrue(len(batches) <= 4, batches)
+        self.assertTrue(all(n > 1 for n in batches[1:]), batches)
+
+    def test_timed_out_job_is_dropped(self):
+        batches = []
+        scheduler = batching.BatchScheduler(lambda batch: batches.append(batch) or batch, window=0.2)
+        with self.assertRaises(deadline.DeadlineExceeded):
+            scheduler.submit(1, timeout=0.05)
+        self.assertEqual(scheduler.submit(2, timeout=1).result, 2)
+        self.assertEqual(batches, [[2]])
+
+    def test_batch_error_reaches_callers(self):
+        def fail(batch):
+            raise ValueError("boom")
+
+        scheduler = batching.BatchScheduler(fail, window=0)
+        with self.assertRaises(ValueError):
+            scheduler.submit(1)
+
+    def test_score_through_scheduler(self):
+        context = {}
+        with mock.patch.object(scoring, "scheduler", batching.BatchScheduler(scoring.calc_scores, window=0)):
+            score = scoring.get_score(DictStore(), "79175002040", "stupnikov@otus.ru", ctx=context)
+        self.assertEqual(score, 3.0)
+        self.assertEqual(context["score_batch_size"], 1)
+        self.assertIn("score_queue_delay_ms", context)
+
+
+class TestInterestsIndex(unittest.TestCase):
+    def test_bloom_filter(self):
+        f = bloom.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            f.add("i:%d" % i)
+        self.assertTrue(all("i:%d" % i in f for i in range(1000)))
+        false_positives = sum("i:x%d" % i in f for i in range(10000))
+        self.assertTrue(false_positives < 300, false_positives)
+        self.assertTrue(0.005 < f.false_positive_rate() < 0.02)
+        self.assertEqual(f.nbytes, len(f.bits))
+        count = f.count
+        self.assertTrue(count > 990)
+        f.add("i:1")
+        self.assertEqual(f.count, count)
+
+    def get_store(self, data):
+        r = FakeRedis(data)
+        s = store.Store(index_capacity=100, primary=r, index_check=0)
+        s.rebuild_index()
+        return s, r
+
+    def test_absent_key_skips_lookup(self):
+        s, r = self.get_store({"i:1": json.dumps(["int1"])})
+        self.assertEqual(s.get("i:1"), ["int1"])
+        with self.assertRaises(RuntimeError):
+            s.get("i:2")
+        self.assertEqual(r.reads, ["i:1"])
+        self.assertEqual(s.index_stats()["skipped_lookups"], 1)
+
+    def test_write_updates_index(self):
+        s, r = self.get_store({})
+        s.cache_set("i:2", ["int1"], 60)
+        self.assertEqual(s.get("i:2"), ["int1"])
+        self.assertEqual(s.index_stats()["keys"], 1)
+
+    def test_own_write_keeps_index_trusted(self):
+        s, r = self.get_store({"i:1": json.dumps(["int1"])})
+        for _ in range(2):
+            s.cache_set("i:5", ["int1"], 60)
+        with self.assertRaises(RuntimeError):
+            s.get("i:2")
+        self.assertEqual(r.reads, [])
+        self.assertEqual(r.scans, 1)
+        self.assertEqual(s.index_stats()["keys"], 2)
+
+    def test_key_written_by_other_client(self):
+        s, r = self.get_store({})
+        with self.assertRaises(RuntimeError):
+            s.get("i:1001")
+        # e.g. the nightly loader: writes records, then bumps the generation
+        r.data["i:1001"] = json.dumps(["int1"])
+        r.incr(store.INDEX_GENERATION_KEY)
+        self.assertEqual(s.get("i:1001"), ["int1"])
+        wait_until(lambda: s.index_stats()["keys"] == 1)
+        self.assertEqual(s.get("i:1001"), ["int1"])
+        with self.assertRaises(RuntimeError):
+            s.get("i:1002")
+        self.assertEqual(s.index_stats()["skipped_lookups"], 2)
+
+
+class TestReplay(unittest.TestCase):
+    LOG = [
+        '[2018.07.20 12:00:00] I Starting server at 8080\n',
+        '[2018.07.20 12:00:01] I /method: {"method": "online_score", "arguments": {}} 5f0e\n',
+        "[2018.07.20 12:00:01] I {'request_id': '5f0e', 'code': 422, 'error': u'Invalid'}\n",
+        '[2018.07.20 12:00:03] I /method: {"method": "clients_interests"} a1b2\n',
+        "[2018.07.20 12:00:03] E Unexpected error: boom\n",
+        "[2018.07.20 12:00:03] I {'request_id': 'a1b2', 'code': 500, 'error': 'Internal Server Error'}\n",
+        '[2018.07.20 12:00:04] I /method: {"method": "online_score"} c3d4\n',
+    ]
+
+    def test_parse_log(self):
+        records = replay.parse_log(self.LOG)
+        self.assertEqual([r.request_id for r in records], ["5f0e", "a1b2", "c3d4"])
+        self.assertEqual([r.code for r in records], [422, 500, None])
+        self.assertEqual([r.ts - records[0].ts for r in records], [0, 2, 3])
+        self.assertEqual(records[0].path, "/method")
+        self.assertEqual(json.loads(records[0].body), {"method": "online_score", "arguments": {}})
+
+    def test_parse_log_msecs(self):
+        records = replay.parse_log([
+            '[2018.07.20 12:00:01.250] I /method: {} 5f0e\n',
+            '[2018.07.20 12:00:01.900] I /method: {} a1b2\n',
+            '[2018.07.20 12:00:02] I /method: {} c3d4\n',
+        ])
+        self.assertEqual([round(r.ts - records[0].ts, 3) for r in records], [0, 0.65, 0.75])
+
+    def test_latency_from_schedule(self):
+        record = replay.parse_log(self.LOG)[0]
+        record.scheduled = time.time() - 1
+        with mock.patch("urllib2.urlopen") as urlopen:
+            urlopen.return_value.code = 200
+            replay.send("http://127.0.0.1:8080", record, 1)
+        self.assertTrue(record.latency >= 1)
+        self.assertTrue(record.lag >= 1)
+        self.assertIn("behind schedule: p50 1", replay.report([record], 1.0))
+
+    @cases([(50, 5), (90, 9), (99, 9), (100, 9)])
+    def test_percentile(self, p, result):
+        self.assertEqual(replay.percentile(range(10), p), result)
+
+    def test_report_code_diffs(self):
+        records = replay.parse_log(self.LOG)
+        for r, code in zip(records, [422, 200, 200]):
+            r.replayed_code, r.latency = code, 0.01
+        report = replay.report(records, 1.0)
+        self.assertIn("code diff: recorded 500, replayed 200: 1", report)
+        self.assertIn("code diff: recorded None, replayed 200: 1", report)
+        self.assertNotIn("recorded 422", report)
+
+    def test_report_failed_separately(self):
+        records = replay.parse_log(self.LOG)
+        for r, code, latency in zip(records, [422, None, None], [0.01, 10, 10]):
+            r.replayed_code, r.latency = code, latency
+        report = replay.report(records, 10.0)
+        self.assertIn("failed: 2", report)
+        self.assertIn("p99 latency: 10.0ms", report)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "interests.snap")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def compile(self, interests):
+        snapshot.compile_snapshot([(cid, json.dumps(v)) for cid, v in interests.items()], self.path)
+
+    def test_lookup(self):
+        interests = {cid: ["int%d" % cid] for cid in range(-5, 200, 3)}
+        self.compile(interests)
+        s = snapshot.Snapshot(self.path)
+        self.assertEqual(s.count, len(interests))
+        for cid in range(-10, 210):
+            self.assertEqual(s.get(cid), interests.get(cid))
+
+    def test_store_hot_swap(self):
+        self.compile({1001: ["int1"]})
+        fallback = DictStore()
+        s = snapshot.SnapshotStore(self.path, fallback)
+        self.assertEqual(scoring.get_interests(s, 1001), ["int1"])
+        with self.assertRaises(RuntimeError):
+            scoring.get_interests(s, 1002)
+        self.assertFalse(s.reload())
+        self.compile({1001: ["int2"], 1002: ["int3"]})
+        self.assertTrue(s.reload())
+        self.assertEqual(scoring.get_interests(s, 1001), ["int2"])
+        self.assertEqual(scoring.get_interests(s, 1002), ["int3"])
+        s.cache_set("uid:1", 1.5, 60)
+        self.assertEqual(fallback.data["uid:1"], 1.5)
+
+    def test_truncated_copy_keeps_old_snapshot(self):
+        self.compile({1001: ["int1"]})
+        s = snapshot.SnapshotStore(self.path, DictStore())
+        self.compile({1001: ["int2"], 1002: ["int3"]})
+        with open(self.path, "rb") as f:
+            data = f.read()
+        index_end = snapshot.HEADER.size + 2 * snapshot.ENTRY.size
+        for n, size in enumerate([0, snapshot.HEADER.size - 1, snapshot.HEADER.size,
+                                  index_end - 1, index_end, len(data) - 1]):
+            # copied over the old file in place, not complete yet
+            with open(self.path, "wb") as f:
+                f.write(data[:size])
+            os.utime(self.path, (n, n))
+            self.assertFalse(s.reload())
+            self.assertEqual(scoring.get_interests(s, 1001), ["int1"])
+        with open(self.path, "wb") as f:
+            f.write(data)
+        self.assertTrue(s.reload())
+        self.assertEqual(scoring.get_interests(s, 1002), ["int3"])
+
+
+class FakeRedisServer(object):
+    # answers GET with `value`, anything else with OK; `slow` commands are
+    # answered after `delay` seconds
+    def __init__(self, value, delay=0, slow=("GET",)):
+        self.value = value
+        self.delay = delay
+        self.slow = slow
+        self.commands = []
+        self.conns = []
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        t = threading.Thread(target=self._accept)
+        t.daemon = True
+        t.start()
+
+    def client(self):
+        return store.connect("127.0.0.1:%d" % self.port)
+
+    def close(self):
+        for sock in [self.sock] + self.conns:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.conns.append(conn)
+            t = threading.Thread(target=self._serve, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _serve(self, conn):
+        f = conn.makefile("rb")
+        try:
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                args = []
+                for _ in range(int(line[1:])):
+                    length = int(f.readline()[1:])
+                    args.append(f.read(length + 2)[:-2])
+                self.commands.append(args)
+                if args[0] in self.slow:
+                    time.sleep(self.delay)
+                if args[0] == "GET":
+                    value = json.dumps(self.value)
+                    conn.sendall("$%d\r\n%s\r\n" % (len(value), value))
+                else:
+                    conn.sendall("+OK\r\n")
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+
+class TestStoreDeadlines(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer("value", delay=0.1)
+        self.store = store.Store(primary=self.server.client())
+
+    def tearDown(self):
+        self.server.close()
+
+    def read_concurrently(self, n, timeout):
+        results = []
+
+        def read():
+            try:
+                results.append(self.store.cache_get("k", timeout=timeout))
+            except deadline.DeadlineExceeded as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_reads_not_capped(self):
+        started = time.time()
+        self.assertEqual(self.read_concurrently(32, 1), ["value"] * 32)
+        self.assertTrue(time.time() - started < 0.3)
+
+    def test_timed_out_reads_leave_no_backlog(self):
+        results = self.read_concurrently(20, 0.02)
+        self.assertTrue(all(isinstance(r, deadline.DeadlineExceeded) for r in results))
+        time.sleep(0.05)
+        sent = len(self.server.commands)
+        started = time.time()
+        self.assertEqual(self.store.cache_get("k", timeout=1), "value")
+        self.assertTrue(time.time() - started < 0.2)
+        self.assertEqual(len(self.server.commands), sent + 1)
+
+    def test_write_deadline(self):
+        self.store.cache_set("k", 1, 60, timeout=1)
+        self.assertEqual(self.server.commands[-1], ["SET", "k", "1", "EX", "60"])
+
+    def assert_times_out(self, func, *args):
+        started = time.time()
+        with self.assertRaises(deadline.DeadlineExceeded):
+            func(*args)
+        self.assertTrue(time.time() - started < 0.08)
+
+    def test_index_check_deadline(self):
+        self.store.index = bloom.BloomFilter(100, 0.01)
+        self.assert_times_out(self.store.get, "i:1", 0.03)
+        self.assertEqual(self.server.commands[-1], ["GET", store.INDEX_GENERATION_KEY])
+
+    def test_generation_bump_deadline(self):
+        self.server.slow = ("INCR",)
+        self.assert_times_out(self.store.cache_set, "i:1", ["int1"], 60, 0.03)
+        self.assertEqual(self.server.commands[-1], ["INCR", store.INDEX_GENERATION_KEY])
+
+    def test_connect_deadline(self):
+        # a listener with a full backlog never completes new connections
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(0)
+        address = "127.0.0.1:%d" % listener.getsockname()[1]
+        fillers = []
+        try:
+            for _ in range(4):
+                sock = socket.socket()
+                sock.setblocking(0)
+                sock.connect_ex(listener.getsockname())
+                fillers.append(sock)
+            s = store.Store(primary=store.connect(address))
+            self.assert_times_out(s.cache_get, "k", 0.03)
+        finally:
+            for sock in fillers + [listener]:
+                sock.close()
+
+
+class TestHedgedReads(unittest.TestCase):
+    def setUp(self):
+        self.replicas, self.primary = [], None
+
+    def get_store(self, replica_delays, **kwargs):
+        self.replicas = [FakeRedisServer("replica%d" % i, d) for i, d in enumerate(replica_delays)]
+        self.primary = FakeRedisServer("primary")
+        kwargs.setdefault("min_hedge_delay", 0.05)
+        s = store.Store(primary=self.primary.client(),
+                        replicas=[r.client() for r in self.replicas], **kwargs)
+        s.latency.value = 0
+        return s
+
+    def tearDown(self):
+        for server in self.replicas + [self.primary]:
+            if server is not None:
+                server.close()
+
+    def test_fast_replica_no_hedge(self):
+        s = self.get_store([0])
+        self.assertEqual(s.cache_get("k"), "replica0")
+        self.assertEqual(s.read_stats()["hedges_fired"], 0)
+        s.cache_set("k", 1, 60)
+        self.assertEqual(self.primary.commands, [["SET", "k", "1", "EX", "60"]])
+        self.assertEqual(self.replicas[0].commands, [["GET", "k"]])
+
+    def test_slow_replica_hedge_wins(self):
+        s = self.get_store([0.5])
+        self.assertEqual(s.cache_get("k"), "primary")
+        stats = s.read_stats()
+        self.assertEqual((stats["hedges_fired"], stats["hedges_won"]), (1, 1))
+
+    def test_failed_read_falls_over(self):
+        s = self.get_store([0])
+        self.replicas[0].close()
+        self.assertEqual(s.cache_get("k"), "primary")
+        self.primary.close()
+        with self.assertRaises(redis.ConnectionError):
+            s.cache_get("k")
+
+    def test_read_deadline(self):
+        s = self.get_store([0.5])
+        self.primary.delay = 0.5
+        with self.assertRaises(deadline.DeadlineExceeded):
+            s.cache_get("k", timeout=0.1)
+        self.assertEqual(s.read_stats()["hedges_fired"], 1)
+
+    def test_concurrent_reads_slow_replica(self):
+        s = self.get_store([0.5], node_threads=8, min_hedge_delay=0.01)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(s.cache_get("k")))
+                   for _ in range(64)]
+        started = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(time.time() - started < 0.4)
+        self.assertEqual(results, ["primary"] * 64)
+        stats = s.read_stats()
+        self.assertEqual((stats["hedges_fired"], stats["hedges_won"]), (64, 64))
+
+    def test_hanging_nodes_bounded(self):
+        s = self.get_store([0.5], read_timeout=0.1)
+        self.primary.delay = 0.5
+        started = time.time()
+        with self.assertRaises(redis.TimeoutError):
+            s.cache_get("k")
+        self.assertTrue(time.time() - started < 0.3)
+
+    def test_latency_tracker(self):
+        tracker = store.LatencyTracker(percentile=90, every=10)
+        for i in range(100):
+            tracker.add(i)
+        self.assertEqual(tracker.value, 90)
+
 
 class TestFields(unittest.TestCase):
 